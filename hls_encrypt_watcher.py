@@ -2,22 +2,46 @@
 # encoding: utf-8
 
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import hashlib
 import logging
+import mmap
 import os
 import re
 import sys
 import time
 import shutil
 import signal
-from typing import Dict, Optional
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional, Set
 from watchdog.observers import Observer
 from watchdog.events import (
+    DirCreatedEvent,
+    FileClosedEvent,
+    FileDeletedEvent,
+    FileMovedEvent,
     FileSystemEventHandler,
 )
-from Crypto.Cipher import AES
+from watchdog.utils import UnsupportedLibcError
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+try:
+    from watchdog.observers.inotify import InotifyObserver
+except (ImportError, UnsupportedLibcError):
+    InotifyObserver = None
 
 BLOCKSIZE = 16
-READ_CHUNK = 64 * 1024
+READ_CHUNK = 1024 * 1024
+WHOLE_SEGMENT_MAX = 8 * 1024 * 1024
+MMAP_MIN = 1024 * 1024
+# Bound on remembered source mtimes; a live stream would otherwise grow it forever.
+PROCESSED_MAX = 4096
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
@@ -55,24 +79,294 @@ def pkcs7_pad_length(length: int) -> int:
     return BLOCKSIZE - (length % BLOCKSIZE)
 
 
-def encrypt_file(in_path: str, out_path: str, key_bytes: bytes, iv_bytes: bytes):
-    cipher = AES.new(key_bytes, AES.MODE_CBC, iv=iv_bytes)
+@lru_cache(maxsize=8)
+def _aes_algorithm(key_bytes: bytes) -> algorithms.AES:
+    # One fixed key per stream: build (and validate) it once per process.
+    return algorithms.AES(key_bytes)
+
+
+def _load_libcrypto():
+    for name in (ctypes.util.find_library("crypto"), "libcrypto.so.3", "libcrypto.so"):
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        lib.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+        lib.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+        lib.EVP_CIPHER_CTX_copy.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        lib.EVP_CIPHER_CTX_set_padding.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.EVP_aes_128_cbc.restype = ctypes.c_void_p
+        lib.EVP_EncryptInit_ex.argtypes = [ctypes.c_void_p] * 5
+        lib.EVP_EncryptUpdate.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.c_void_p, ctypes.c_int,
+        ]
+        lib.EVP_EncryptFinal_ex.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+        return lib
+    return None
+
+
+_libcrypto = _load_libcrypto()
+
+
+class _PyBuffer(ctypes.Structure):
+    _fields_ = [
+        ("buf", ctypes.c_void_p),
+        ("obj", ctypes.c_void_p),
+        ("len", ctypes.c_ssize_t),
+        ("itemsize", ctypes.c_ssize_t),
+        ("readonly", ctypes.c_int),
+        ("ndim", ctypes.c_int),
+        ("format", ctypes.c_char_p),
+        ("shape", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("strides", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("suboffsets", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("internal", ctypes.c_void_p),
+    ]
+
+
+PyBUF_SIMPLE = 0
+PyBUF_WRITABLE = 1
+ctypes.pythonapi.PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer), ctypes.c_int]
+ctypes.pythonapi.PyBuffer_Release.argtypes = [ctypes.POINTER(_PyBuffer)]
+
+
+@contextlib.contextmanager
+def _buffer_ptr(buf, writable: bool = False):
+    # Unlike ctypes' from_buffer this also accepts read-only buffers (bytes, ACCESS_READ mmaps).
+    view = _PyBuffer()
+    flags = PyBUF_WRITABLE if writable else PyBUF_SIMPLE
+    ctypes.pythonapi.PyObject_GetBuffer(buf, ctypes.byref(view), flags)
+    try:
+        yield view.buf
+    finally:
+        ctypes.pythonapi.PyBuffer_Release(ctypes.byref(view))
+
+
+class _EVPKeyContext:
+    """Keyed template EVP_CIPHER_CTX; never used to encrypt, only copied."""
+
+    def __init__(self, key_bytes: bytes):
+        self._lib = _libcrypto
+        self.ctx = _libcrypto.EVP_CIPHER_CTX_new()
+        if not self.ctx:
+            raise MemoryError("EVP_CIPHER_CTX_new failed")
+        if not _libcrypto.EVP_EncryptInit_ex(self.ctx, _libcrypto.EVP_aes_128_cbc(), None, key_bytes, None):
+            raise RuntimeError("EVP_EncryptInit_ex failed")
+
+    def __del__(self):
+        if getattr(self, "ctx", None):
+            self._lib.EVP_CIPHER_CTX_free(self.ctx)
+            self.ctx = None
+
+
+@lru_cache(maxsize=8)
+def _evp_key_context(key_bytes: bytes) -> _EVPKeyContext:
+    # The stream key never changes, so expand it once per worker process.
+    return _EVPKeyContext(key_bytes)
+
+
+class _EVPEncryptor:
+    """AES-128-CBC encryptor calling libcrypto's EVP API directly.
+
+    Mirrors the update/update_into/finalize interface of cryptography's
+    encryptor, without its per-call wrapper overhead. Padding is left to
+    the caller, as with cryptography.
+
+    Each encryptor owns a copy of a per-key template context and only sets
+    the IV on it, so the key schedule is not recomputed for every segment.
+    """
+
+    def __init__(self, key_bytes: bytes, iv_bytes: bytes):
+        self._lib = _libcrypto
+        self._ctx = _libcrypto.EVP_CIPHER_CTX_new()
+        if not self._ctx:
+            raise MemoryError("EVP_CIPHER_CTX_new failed")
+        if not _libcrypto.EVP_CIPHER_CTX_copy(self._ctx, _evp_key_context(key_bytes).ctx):
+            raise RuntimeError("EVP_CIPHER_CTX_copy failed")
+        if not _libcrypto.EVP_EncryptInit_ex(self._ctx, None, None, None, iv_bytes):
+            raise RuntimeError("EVP_EncryptInit_ex failed")
+        _libcrypto.EVP_CIPHER_CTX_set_padding(self._ctx, 0)
+        self._outl = ctypes.c_int()
+
+    def __del__(self):
+        if getattr(self, "_ctx", None):
+            self._lib.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+    def update_into(self, data, out) -> int:
+        n = len(data)
+        if len(out) < n + BLOCKSIZE - 1:
+            raise ValueError("output buffer too small")
+        with _buffer_ptr(out, writable=True) as out_ptr, _buffer_ptr(data) as in_ptr:
+            ok = _libcrypto.EVP_EncryptUpdate(self._ctx, out_ptr, ctypes.byref(self._outl), in_ptr, n)
+        if not ok:
+            raise RuntimeError("EVP_EncryptUpdate failed")
+        return self._outl.value
+
+    def update(self, data) -> bytes:
+        out = bytearray(len(data) + BLOCKSIZE)
+        return bytes(memoryview(out)[:self.update_into(data, out)])
+
+    def finalize(self) -> bytes:
+        out = bytearray(BLOCKSIZE)
+        with _buffer_ptr(out, writable=True) as out_ptr:
+            ok = _libcrypto.EVP_EncryptFinal_ex(self._ctx, out_ptr, ctypes.byref(self._outl))
+        if not ok:
+            raise RuntimeError("EVP_EncryptFinal_ex failed (input not block aligned?)")
+        return bytes(out[:self._outl.value])
+
+
+def _new_encryptor(key_bytes: bytes, iv_bytes: bytes):
+    # HLS METHOD=AES-128 mandates CBC with PKCS7 padding.
+    if _libcrypto is not None and len(key_bytes) == 16:
+        return _EVPEncryptor(key_bytes, iv_bytes)
+    return Cipher(_aes_algorithm(key_bytes), modes.CBC(iv_bytes)).encryptor()
+
+
+def _writev_all(fd: int, views: list):
+    views = [v for v in views if len(v)]
+    while views:
+        n = os.writev(fd, views)
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n:
+            views[0] = views[0][n:]
+
+
+# Per-process scratch buffers, reused across segments to avoid reallocating them per file.
+_scratch: Dict[str, bytearray] = {}
+
+
+def _scratch_buffer(name: str, size: int) -> memoryview:
+    buf = _scratch.get(name)
+    if buf is None or len(buf) < size:
+        buf = _scratch[name] = bytearray(size)
+    return memoryview(buf)[:size]
+
+
+def _encrypt_whole(fin, fd: int, encryptor, size: int):
+    # One update() call lets OpenSSL's AES loop run over the whole segment.
+    mv = _scratch_buffer("in", size + BLOCKSIZE)
+    n = fin.readinto(mv[:size])
+    pad_len = pkcs7_pad_length(n)
+    mv[n:n + pad_len] = bytes([pad_len]) * pad_len
+    out = _scratch_buffer("out0", n + pad_len + BLOCKSIZE)
+    written = encryptor.update_into(mv[:n + pad_len], out)
+    _writev_all(fd, [out[:written], encryptor.finalize()])
+
+
+def _encrypt_chunked(fin, fd: int, encryptor):
+    mv = _scratch_buffer("in", READ_CHUNK)
+    # Two output buffers: one can wait in the writev batch while the next chunk is encrypted.
+    out_bufs = [_scratch_buffer(name, READ_CHUNK + BLOCKSIZE) for name in ("out0", "out1")]
+    pending = []
+    pending_len = 0
+    total = 0
+    i = 0
+    while True:
+        n = fin.readinto(mv)
+        if not n:
+            break
+        out_buf = out_bufs[i & 1]
+        written = encryptor.update_into(mv[:n], out_buf)
+        pending.append(out_buf[:written])
+        pending_len += written
+        if pending_len >= READ_CHUNK or len(pending) == len(out_bufs):
+            _writev_all(fd, pending)
+            pending = []
+            pending_len = 0
+        total += n
+        i += 1
+    pad_len = pkcs7_pad_length(total)
+    pending.append(encryptor.update(bytes([pad_len]) * pad_len))
+    pending.append(encryptor.finalize())
+    _writev_all(fd, pending)
+
+
+def _encrypt_mapped(mm: mmap.mmap, fd: int, encryptor, size: int):
+    # Encrypt straight out of the page cache; segments up to WHOLE_SEGMENT_MAX in one call.
+    step = size if size <= WHOLE_SEGMENT_MAX else READ_CHUNK
+    # A single step needs only one output buffer; the second is for alternating chunks.
+    names = ("out0", "out1") if size > step else ("out0",)
+    out_bufs = [_scratch_buffer(name, step + BLOCKSIZE) for name in names]
+    pending = []
+    pending_len = 0
+    with memoryview(mm) as mv:
+        for i, off in enumerate(range(0, size, step)):
+            out_buf = out_bufs[i & 1]
+            written = encryptor.update_into(mv[off:off + step], out_buf)
+            pending.append(out_buf[:written])
+            pending_len += written
+            if pending_len >= READ_CHUNK or len(pending) == len(out_bufs):
+                _writev_all(fd, pending)
+                pending = []
+                pending_len = 0
+    pad_len = pkcs7_pad_length(size)
+    pending.append(encryptor.update(bytes([pad_len]) * pad_len))
+    pending.append(encryptor.finalize())
+    _writev_all(fd, pending)
+
+
+def _map_input(fin) -> Optional[mmap.mmap]:
+    try:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def encrypt_file_staged(in_path: str, out_path: str, key_bytes: bytes, iv_bytes: bytes, sync: bool = False) -> str:
+    """Encrypt in_path into a unique temp file next to out_path and return its path.
+
+    The caller moves it into place (or discards it), so clients never fetch a
+    partially encrypted segment and a superseded job never overwrites a newer one.
+    """
+    # OpenSSL EVP buffers partial blocks internally, so chunks can be fed as-is.
+    encryptor = _new_encryptor(key_bytes, iv_bytes)
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(in_path, "rb") as fin, open(out_path, "wb") as fout:
-        prev = b""
-        while True:
-            chunk = fin.read(READ_CHUNK)
-            if not chunk:
-                pad_len = pkcs7_pad_length(len(prev))
-                padded = prev + bytes([pad_len]) * pad_len
-                if padded:
-                    fout.write(cipher.encrypt(padded))
-                break
-            data = prev + chunk
-            full_len = (len(data) // BLOCKSIZE) * BLOCKSIZE
-            if full_len > 0:
-                fout.write(cipher.encrypt(data[:full_len]))
-            prev = data[full_len:]
+    with open(in_path, "rb") as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fin.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(out_path), prefix=os.path.basename(out_path) + ".", suffix=".tmp"
+        )
+        try:
+            os.fchmod(fd, 0o644)
+            try:
+                mm = _map_input(fin) if size >= MMAP_MIN else None
+                if mm is not None:
+                    with mm:
+                        _encrypt_mapped(mm, fd, encryptor, len(mm))
+                elif size <= WHOLE_SEGMENT_MAX:
+                    _encrypt_whole(fin, fd, encryptor, size)
+                else:
+                    _encrypt_chunked(fin, fd, encryptor)
+                if sync:
+                    # One data flush per finished segment, not per write.
+                    getattr(os, "fdatasync", os.fsync)(fd)
+            finally:
+                os.close(fd)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+    return tmp_path
+
+
+def encrypt_file(in_path: str, out_path: str, key_bytes: bytes, iv_bytes: bytes, sync: bool = False):
+    tmp_path = encrypt_file_staged(in_path, out_path, key_bytes, iv_bytes, sync)
+    try:
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
 
 
 # ===== m3u8 =====
@@ -83,28 +377,38 @@ def build_ext_x_key(key_uri: str, iv_bytes: Optional[bytes]) -> str:
     return line + "\n"
 
 
-def insert_ext_x_key(lines, key_line: str):
+def insert_ext_x_key(lines, key_line: bytes):
+    # Single pass: remember the first MAP and first EXTINF/URI line, stop at an existing KEY.
+    map_idx = extinf_idx = -1
     for i, l in enumerate(lines):
-        if l.startswith("#EXT-X-KEY"):
+        if not l.startswith(b"#"):
+            if extinf_idx < 0:
+                extinf_idx = i
+        elif l.startswith(b"#EXT-X-KEY"):
             lines[i] = key_line
-            break
+            return lines
+        elif l.startswith(b"#EXT-X-MAP"):
+            if map_idx < 0:
+                map_idx = i
+        elif l.startswith(b"#EXTINF"):
+            if extinf_idx < 0:
+                extinf_idx = i
+    if map_idx >= 0:
+        insert_at = map_idx
+    elif extinf_idx >= 0:
+        insert_at = extinf_idx
     else:
-        insert_at = None
-        for i, l in enumerate(lines):
-            if l.startswith("#EXT-X-MAP"):
-                insert_at = i
-                break
-        if insert_at is None:
-            for i, l in enumerate(lines):
-                if l.startswith("#EXTINF") or not l.startswith("#"):
-                    insert_at = i
-                    break
-        if insert_at is None:
-            insert_at = len(lines)
-        lines.insert(insert_at, key_line)
+        insert_at = len(lines)
+    lines.insert(insert_at, key_line)
     return lines
 
 
+def _pool_worker_init():
+    # Workers inherit main()'s SIGTERM handler; only the parent shuts down and cleans dst.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
 class HLSHandler(FileSystemEventHandler):
     def __init__(
         self,
@@ -117,6 +421,8 @@ class HLSHandler(FileSystemEventHandler):
         pattern_re: Optional[re.Pattern],
         stable_tries: int,
         stable_interval: float,
+        close_events: bool = False,
+        sync: bool = False,
     ):
         super().__init__()
         self.key_uri = key_uri
@@ -125,10 +431,25 @@ class HLSHandler(FileSystemEventHandler):
         self.src_dir = os.path.abspath(src_dir)
         self.dst_dir = os.path.abspath(dst_dir)
         self.exts = exts
+        # Extension (lowercase, no dot) -> kind; m3u8 last so it always wins.
+        self._ext_table: Dict[str, str] = {e.lower().lstrip("."): "seg" for e in exts}
+        self._ext_table["m3u8"] = "m3u8"
         self.pattern_re = pattern_re
         self.stable_tries = stable_tries
         self.stable_interval = stable_interval
-        self._processed_mtime: Dict[str, float] = {}
+        # With inotify, IN_CLOSE_WRITE marks a segment as final; no size polling needed.
+        self.close_events = close_events
+        self.sync = sync
+        self._processed_mtime: "OrderedDict[str, float]" = OrderedDict()
+        self._m3u8_hash: Dict[str, bytes] = {}
+        self._key_line = build_ext_x_key(key_uri, iv_bytes).encode("utf-8")
+        self._pool = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_pool_worker_init)
+        self._pending: Dict[str, Future] = {}
+        # Playlists held back until the segments in their directory are in dst.
+        self._deferred_m3u8: Set[str] = set()
+        self._closed = False
+        # Guards handler state shared by the watchdog thread and the pool's callback thread.
+        self._lock = threading.RLock()
 
     # ---- utils ----
     def _rel_dst(self, src_path: str) -> str:
@@ -136,20 +457,24 @@ class HLSHandler(FileSystemEventHandler):
         return os.path.join(self.dst_dir, rel)
 
     def _process(self, path: str):
-        if self._match_m3u8(path):
+        kind = self._kind(path)
+        if kind == "m3u8":
             self._process_m3u8(path)
-        elif self._match_segment(path):
+        elif kind == "seg":
             self._process_segment(path)
 
+    def _kind(self, path: str) -> Optional[str]:
+        _, dot, ext = path.rpartition(".")
+        kind = self._ext_table.get(ext.lower()) if dot else None
+        if self.pattern_re and kind != "m3u8":
+            return "seg" if self.pattern_re.search(os.path.basename(path)) else None
+        return kind
+
     def _match_m3u8(self, path: str) -> bool:
-        return path.lower().endswith(".m3u8")
+        return self._kind(path) == "m3u8"
 
     def _match_segment(self, path: str) -> bool:
-        base = os.path.basename(path)
-        if self.pattern_re:
-            return bool(self.pattern_re.search(base))
-        _, ext = os.path.splitext(base)
-        return ext.lower() in self.exts
+        return self._kind(path) == "seg"
 
     def _stable_wait(self, src_path: str) -> bool:
         last_size = -1
@@ -169,26 +494,54 @@ class HLSHandler(FileSystemEventHandler):
             mtime = os.path.getmtime(src_path)
         except FileNotFoundError:
             return False
-        prev = self._processed_mtime.get(src_path)
-        if prev is not None and mtime <= prev:
-            return False
-        self._processed_mtime[src_path] = mtime
+        with self._lock:
+            prev = self._processed_mtime.get(src_path)
+            if prev is not None and mtime <= prev:
+                return False
+            self._processed_mtime[src_path] = mtime
+            self._processed_mtime.move_to_end(src_path)
+            if len(self._processed_mtime) > PROCESSED_MAX:
+                self._processed_mtime.popitem(last=False)
         return True
 
+    def _has_pending_in(self, dir_path: str) -> bool:
+        return any(os.path.dirname(p) == dir_path for p in self._pending)
+
     def _process_m3u8(self, src_path: str):
-        if not os.path.exists(src_path):
-            return
+        with self._lock:
+            if self._closed or not os.path.exists(src_path):
+                return
+            # A playlist must not list a segment before its ciphertext is in place;
+            # _segment_done re-runs it once the directory's segments are done.
+            if self._has_pending_in(os.path.dirname(src_path)):
+                self._deferred_m3u8.add(src_path)
+                return
+            self._write_m3u8(src_path)
+
+    def _write_m3u8(self, src_path: str):
         if not self._should_process(src_path):
             return
         dst_path = self._rel_dst(src_path)
         os.makedirs(os.path.dirname(dst_path), exist_ok=True)
         try:
-            with open(src_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-            key_line = build_ext_x_key(self.key_uri, self.iv_bytes)
-            lines = insert_ext_x_key(lines, key_line)
-            with open(dst_path, "w", encoding="utf-8") as f:
-                f.writelines(lines)
+            with open(src_path, "rb") as f:
+                raw = f.read()
+            # ffmpeg rewrites the playlist often; skip when the content is unchanged.
+            h = hashlib.sha1(raw).digest()
+            if self._m3u8_hash.get(src_path) == h and os.path.exists(dst_path):
+                return
+            lines = insert_ext_x_key(raw.splitlines(keepends=True), self._key_line)
+            # Write aside and rename so clients never fetch a half-written playlist.
+            tmp_path = dst_path + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(b"".join(lines))
+                os.replace(tmp_path, dst_path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+                raise
+            self._m3u8_hash[src_path] = h
             logging.debug("m3u8 processed: %s -> %s", src_path, dst_path)
         except Exception:
             logging.exception("Failed to process m3u8: %s", src_path)
@@ -198,33 +551,95 @@ class HLSHandler(FileSystemEventHandler):
             return
         if not self._should_process(src_path):
             return
-        stable = self._stable_wait(src_path)
-        if not stable:
+        if not self.close_events and not self._stable_wait(src_path):
             logging.warning("Segment not stable; proceeding: %s", src_path)
         dst_path = self._rel_dst(src_path)
+        with self._lock:
+            if self._closed:
+                return
+            future = self._pool.submit(
+                encrypt_file_staged,
+                src_path,
+                dst_path,
+                self.key_bytes,
+                self.iv_bytes or bytes(16),
+                self.sync,
+            )
+            # Register the new job before cancelling the old one, so the old job's
+            # callback still sees work pending in this directory.
+            prev = self._pending.get(src_path)
+            self._pending[src_path] = future
+            if prev is not None:
+                prev.cancel()
+        future.add_done_callback(lambda f: self._segment_done(src_path, dst_path, f))
+
+    def _segment_done(self, src_path: str, dst_path: str, future: Future):
+        with self._lock:
+            # Only the newest job for a path may publish; a superseded one that was
+            # already running (and so could not be cancelled) has its output dropped.
+            current = self._pending.get(src_path) is future
+            if current:
+                del self._pending[src_path]
+            if not future.cancelled():
+                self._publish_segment(src_path, dst_path, future, current)
+            dir_path = os.path.dirname(src_path)
+            if self._closed or self._has_pending_in(dir_path):
+                return
+            ready = [p for p in self._deferred_m3u8 if os.path.dirname(p) == dir_path]
+            self._deferred_m3u8.difference_update(ready)
+            for m3u8_path in ready:
+                self._write_m3u8(m3u8_path)
+
+    def _publish_segment(self, src_path: str, dst_path: str, future: Future, current: bool):
+        exc = future.exception()
+        if exc is not None:
+            logging.error("Encrypt failed: %s", src_path, exc_info=exc)
+            return
+        tmp_path = future.result()
         try:
-            encrypt_file(src_path, dst_path, self.key_bytes, self.iv_bytes or bytes(16))
-            logging.debug("Encrypted: %s -> %s", src_path, dst_path)
+            if not current or self._closed:
+                logging.debug("Superseded, dropped: %s", src_path)
+            elif not os.path.exists(src_path):
+                # Deleted while encrypting; on_deleted could not cancel a running job.
+                logging.debug("Source gone, dropped: %s", src_path)
+            else:
+                os.replace(tmp_path, dst_path)
+                logging.debug("Encrypted: %s -> %s", src_path, dst_path)
         except Exception:
-            logging.exception("Encrypt failed: %s", src_path)
+            logging.exception("Publishing encrypted segment failed: %s", dst_path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        # Outside the lock: _segment_done needs it while the pool drains.
+        self._pool.shutdown(wait=True, cancel_futures=True)
 
     def _delete_mirror_path(self, src_path: str):
+        with self._lock:
+            self._processed_mtime.pop(src_path, None)
         dst_path = self._rel_dst(src_path)
         try:
             if os.path.exists(dst_path):
                 os.remove(dst_path)
-                self._processed_mtime.pop(src_path, None)
                 logging.debug("Deleted mirror file: %s", dst_path)
         except Exception:
             logging.exception("Mirror delete failed: %s", dst_path)
 
     # ---- events ----
     def on_created(self, event):
-        if event.is_directory:
+        if event.is_directory or self.close_events:
             return
         self._process(event.src_path)
 
     def on_modified(self, event):
+        if event.is_directory or self.close_events:
+            return
+        self._process(event.src_path)
+
+    def on_closed(self, event):
         if event.is_directory:
             return
         self._process(event.src_path)
@@ -232,10 +647,24 @@ class HLSHandler(FileSystemEventHandler):
     def on_moved(self, event):
         if event.is_directory:
             return
+        if not event.dest_path:
+            self.on_deleted(event)
+            return
         self._process(event.dest_path)
 
     def on_deleted(self, event):
-        if self._match_segment(event.src_path):
+        if self._match_m3u8(event.src_path):
+            # The mirrored playlist is kept; just forget the source's state.
+            with self._lock:
+                self._processed_mtime.pop(event.src_path, None)
+                self._m3u8_hash.pop(event.src_path, None)
+                self._deferred_m3u8.discard(event.src_path)
+        elif self._match_segment(event.src_path):
+            with self._lock:
+                future = self._pending.get(event.src_path)
+            # A running job cannot be cancelled; _segment_done drops its output instead.
+            if future is not None:
+                future.cancel()
             self._delete_mirror_path(event.src_path)
 
 def main():
@@ -255,6 +684,11 @@ def main():
     p.add_argument("--pattern", help="Regex for segment filenames (overrides --exts)")
     p.add_argument("--stable-tries", type=int, default=20, help="Tries to wait for file size to stabilize")
     p.add_argument("--stable-interval", type=float, default=0.1, help="Seconds between stability checks")
+    p.add_argument(
+        "--sync",
+        action="store_true",
+        help="fdatasync each encrypted segment once written (off: leave flushing to the kernel)",
+    )
     args = p.parse_args()
 
     key_uri = key_file = iv_bytes = None
@@ -278,6 +712,15 @@ def main():
     src = os.path.abspath(args.src)
     dst = os.path.abspath(args.dst)
 
+    if InotifyObserver is not None:
+        # Full events report files moved in from outside src as moves rather than creates.
+        observer = InotifyObserver(generate_full_events=True)
+        # DirCreatedEvent keeps IN_CREATE in the mask, so new rendition subdirectories get watched.
+        event_filter = [DirCreatedEvent, FileClosedEvent, FileMovedEvent, FileDeletedEvent]
+    else:
+        observer = Observer()
+        event_filter = None
+
     handler = HLSHandler(
         key_uri=key_uri,
         iv_bytes=iv_bytes,
@@ -288,21 +731,27 @@ def main():
         pattern_re=pattern_re,
         stable_tries=args.stable_tries,
         stable_interval=args.stable_interval,
+        close_events=InotifyObserver is not None,
+        sync=args.sync,
     )
-    for file_path in os.listdir(src):
-        handler._process(src + "/" + file_path)
+    with os.scandir(src) as it:
+        for entry in it:
+            if entry.is_file():
+                handler._process(entry.path)
 
-    observer = Observer()
-    observer.schedule(handler, src, recursive=True)
+    observer.schedule(handler, src, recursive=True, event_filter=event_filter)
     observer.start()
 
     logging.info("Watching src=%s -> dst=%s", src, dst)
 
     def _graceful_exit(signum, frame):
         logging.info("Stopping..., cleaning dst=%s", dst)
+        observer.stop()
+        observer.join()
+        # Drain the pool first so no worker writes back into the cleaned dst.
+        handler.close()
         shutil.rmtree(dst, ignore_errors=True)
         os.mkdir(dst)
-        observer.stop()
     signal.signal(signal.SIGTERM, _graceful_exit)
 
     try:
@@ -311,6 +760,7 @@ def main():
     except KeyboardInterrupt:
         _graceful_exit(None, None)
     observer.join()
+    handler.close()
 
 
 if __name__ == "__main__":
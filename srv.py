@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
 
 import os
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import stat
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+CONTENT_TYPES = {
+    "m3u8": "application/vnd.apple.mpegurl",
+    "m4s": "video/iso.segment",
+    "mp4": "video/mp4",
+}
 
 
 class MyRequestHandler(SimpleHTTPRequestHandler):
+    # Keep-alive lets players fetch playlist, key and segments over one connection.
+    protocol_version = "HTTP/1.1"
+
     def send_acao(self):
         origin = self.headers["Origin"]
         self.send_header("Access-Control-Allow-Origin", origin)
@@ -13,47 +25,83 @@ class MyRequestHandler(SimpleHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Credentials", "true")
 
     def send_content_type(self):
-        content_type = ""
-        if self.path.endswith(".m3u8"):
-            content_type = "application/vnd.apple.mpegurl"
-        elif self.path.endswith(".m4s"):
-            content_type = "video/iso.segment"
-        elif self.path.endswith(".mp4"):
-            content_type = "video/mp4"
-
-        if content_type != "":
+        _, dot, ext = self.path.rpartition(".")
+        content_type = CONTENT_TYPES.get(ext) if dot else None
+        if content_type is not None:
             self.send_header("Content-type", content_type)
 
-    def do_GET(self):
-        data, ok = read_resource(os.path.basename(self.path))
-        if not ok:
-            self.send_response(404)
-            self.end_headers()
-            return
-
+    def send_ok(self, length):
         self.send_response(200)
         self.send_acao()
         self.send_content_type()
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def send_not_found(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(data)
+
+    def do_GET(self):
+        found = stat_resource(os.path.basename(self.path))
+        if found is None:
+            self.send_not_found()
+            return
+
+        path, st = found
+        if is_hot(path):
+            # Playlists and keys are polled by every player; serve them from memory.
+            try:
+                data = load_cached(path, st.st_mtime_ns, st.st_size)
+            except OSError:
+                self.send_not_found()
+                return
+            self.send_ok(len(data))
+            self.wfile.write(data)
+            return
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_not_found()
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_ok(size)
+            # Zero-copy from page cache to socket (os.sendfile where available).
+            self.connection.sendfile(f, 0, size)
         return
 
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_acao()
+        self.send_header("Content-Length", "0")
         self.end_headers()
         return
 
 
-def read_resource(basename):
-    if os.path.exists("enc/"+basename):
-        with open("enc/"+basename, "rb") as f:
-            return f.read(), True
-    if os.path.exists("keys/"+basename):
-        with open("keys/"+basename, "rb") as f:
-            return f.read(), True
-    return b"", False
+def stat_resource(basename):
+    for d in ("enc/", "keys/"):
+        path = d+basename
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            return path, st
+    return None
+
+
+def is_hot(path):
+    return path.startswith("keys/") or path.endswith(".m3u8")
+
+
+# Keyed on mtime and size so a rewritten playlist misses the cache.
+@lru_cache(maxsize=256)
+def load_cached(path, mtime_ns, size):
+    with open(path, "rb") as f:
+        return f.read()
 
 
-httpd = HTTPServer(("0.0.0.0", 8003), MyRequestHandler)
+httpd = ThreadingHTTPServer(("0.0.0.0", 8003), MyRequestHandler)
 httpd.serve_forever()